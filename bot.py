@@ -1,5 +1,6 @@
 import os
 import shutil
+import asyncio
 import logging
 from datetime import datetime
 from dotenv import load_dotenv
@@ -15,19 +16,49 @@ from telegram.ext import (
     MessageHandler,
     filters,
     CallbackQueryHandler,
-    ConversationHandler
+    ConversationHandler,
+    TypeHandler
 )
 import database as db
+import wireguard as wg
+from ratelimit import SlidingWindowLimiter
+from state import TTLStore, UserState, PendingRequest
 
 # Загрузка переменных окружения
 load_dotenv()
 TOKEN = os.getenv('TOKEN')
 ADMIN_ID = int(os.getenv('ADMIN_ID'))
 
+# Ограничения на выдачу конфигов
+RATE_LIMIT_WINDOW = int(os.getenv('RATE_LIMIT_WINDOW', 3600))  # Окно в секундах
+USER_RATE_LIMIT = int(os.getenv('USER_RATE_LIMIT', 3))  # Запросов на пользователя в окне
+ORG_RATE_LIMIT = int(os.getenv('ORG_RATE_LIMIT', 20))  # Запросов на организацию в окне
+CONFIGS_PER_USER = int(os.getenv('CONFIGS_PER_USER', 1))  # Активных конфигов на пользователя
+
+# Ограничения на хранение состояния в памяти
+CONVERSATION_TIMEOUT = int(os.getenv('CONVERSATION_TIMEOUT', 300))  # Таймаут диалога в секундах
+STATE_TTL = int(os.getenv('STATE_TTL', 3600))  # Время жизни состояния пользователя
+PENDING_REQUEST_TTL = int(os.getenv('PENDING_REQUEST_TTL', 86400))  # Время жизни запроса без решения
+STATE_MAX_SIZE = int(os.getenv('STATE_MAX_SIZE', 10000))  # Максимум записей в каждом хранилище
+STATE_PURGE_INTERVAL = int(os.getenv('STATE_PURGE_INTERVAL', 600))  # Период очистки в секундах
+
+# Режим генерации конфигов по запросу (вместо готовых файлов)
+WG_GENERATOR = os.getenv('WG_GENERATOR', '').lower() in ('1', 'true', 'yes')
+WG_SERVER_PUBLIC_KEY = os.getenv('WG_SERVER_PUBLIC_KEY')
+WG_ENDPOINT = os.getenv('WG_ENDPOINT')  # host:port сервера
+WG_SUBNET = os.getenv('WG_SUBNET', '10.8.0.0/24')
+WG_SERVER_ADDRESS = os.getenv('WG_SERVER_ADDRESS')  # По умолчанию первый адрес подсети
+WG_DNS = os.getenv('WG_DNS', '1.1.1.1')
+WG_INTERFACE = os.getenv('WG_INTERFACE')  # Если задан, пир добавляется на сервер автоматически
+WG_KEY_POOL_SIZE = int(os.getenv('WG_KEY_POOL_SIZE', 20))
+WG_KEY_POOL_LOW_WATERMARK = int(os.getenv('WG_KEY_POOL_LOW_WATERMARK', 5))
+WG_KEYGEN_WORKERS = int(os.getenv('WG_KEYGEN_WORKERS', 2))
+
 # Пути к директориям
 BASE_DIR = os.path.dirname(os.path.abspath(__file__))
 AVAILABLE_DIR = os.path.join(BASE_DIR, 'configs', 'available')
 USED_DIR = os.path.join(BASE_DIR, 'configs', 'used')
+REVOKED_DIR = os.path.join(BASE_DIR, 'configs', 'revoked')  # Карантин отозванных конфигов
 LOG_FILE = os.path.join(BASE_DIR, 'data', 'bot.log')
 ADMINS_FILE = os.path.join(BASE_DIR, 'data', 'admins.txt')  # Файл со списком администраторов
 
@@ -44,8 +75,13 @@ FIO, ORG = range(2)
 GRANT_ADMIN = range(1)  # Состояние для выдачи прав администратора
 
 # Глобальные структуры данных
-pending_requests = {}
-list_state = {}
+pending_requests = TTLStore(PENDING_REQUEST_TTL)  # user_id -> PendingRequest, без вытеснения по размеру
+user_states = TTLStore(STATE_TTL, STATE_MAX_SIZE)  # user_id -> UserState
+issued_cache = TTLStore(STATE_TTL, STATE_MAX_SIZE)  # user_id -> действующий конфиг пользователя, достигшего лимита
+user_limiter = SlidingWindowLimiter(USER_RATE_LIMIT, RATE_LIMIT_WINDOW)
+org_limiter = SlidingWindowLimiter(ORG_RATE_LIMIT, RATE_LIMIT_WINDOW)
+config_generator = None  # Создаётся в main() при включённом WG_GENERATOR
+in_flight_configs = set()  # Конфиги, выдаваемые через /getfast прямо сейчас
 
 # Функции для работы с администраторами
 def init_admins():
@@ -92,11 +128,167 @@ def check_configs():
         os.makedirs(AVAILABLE_DIR)
     if not os.path.exists(USED_DIR):
         os.makedirs(USED_DIR)
+    if not os.path.exists(REVOKED_DIR):
+        os.makedirs(REVOKED_DIR)
     
     configs = [f for f in os.listdir(AVAILABLE_DIR) if f.endswith('.conf')]
     logger.info(f"Доступно конфигов: {len(configs)}")
     return configs
 
+def init_generator():
+    """Инициализация генератора конфигов"""
+    global config_generator
+    if not WG_GENERATOR:
+        return
+    if not WG_SERVER_PUBLIC_KEY or not WG_ENDPOINT:
+        logger.error("Для режима генерации необходимы WG_SERVER_PUBLIC_KEY и WG_ENDPOINT")
+        return
+    try:
+        config_generator = wg.ConfigGenerator(
+            WG_SERVER_PUBLIC_KEY,
+            WG_ENDPOINT,
+            WG_SUBNET,
+            [AVAILABLE_DIR, USED_DIR, REVOKED_DIR],
+            server_address=WG_SERVER_ADDRESS,
+            dns=WG_DNS,
+            interface=WG_INTERFACE,
+            key_pool_size=WG_KEY_POOL_SIZE,
+            key_pool_low_watermark=WG_KEY_POOL_LOW_WATERMARK,
+            keygen_workers=WG_KEYGEN_WORKERS
+        )
+    except Exception as e:
+        logger.error(f"Ошибка инициализации генератора конфигов: {e}", exc_info=True)
+
+async def take_config(context: ContextTypes.DEFAULT_TYPE):
+    """Выбор конфига для выдачи: из пула, а при его отсутствии — сгенерированный"""
+    # Вызывающий код резервирует конфиг (pending_requests или in_flight_configs) без промежуточных await
+    # Файлы, закреплённые за ожидающими и выполняющимися выдачами, пропускаем
+    reserved = {request.config_file for request in pending_requests.values()} | in_flight_configs
+    configs = [f for f in check_configs() if f not in reserved]
+    if configs:
+        return configs[0]
+    if not config_generator:
+        return None
+    
+    try:
+        # Генерация вызывает wg и не должна блокировать цикл событий
+        config_file, peer_settings = await asyncio.to_thread(config_generator.generate, AVAILABLE_DIR)
+    except Exception as e:
+        logger.error(f"Ошибка генерации конфига: {e}", exc_info=True)
+        return None
+    
+    if peer_settings:
+        # Без await, чтобы вызывающий код успел зарезервировать конфиг
+        context.application.create_task(
+            notify_admin(context, f"🆕 Сгенерирован конфиг {config_file}. Добавьте пир на сервер:\n{peer_settings}")
+        )
+    return config_file
+
+def get_cached_config(user_id):
+    """Действующий конфиг пользователя, если лимит конфигов исчерпан"""
+    config_file = issued_cache.get(user_id)
+    if config_file:
+        return config_file
+    
+    # Учитываем только конфиги, которые действительно у пользователя (файл в used)
+    records = [r for r in db.get_active_configs_by_user(user_id)
+               if os.path.exists(os.path.join(USED_DIR, r[5]))]
+    if CONFIGS_PER_USER > 0 and len(records) >= CONFIGS_PER_USER:
+        config_file = records[0][5]
+        issued_cache.set(user_id, config_file)
+        return config_file
+    return None
+
+def record_issue(user_id, username, full_name, organization, config_file, issue_type="standard"):
+    """Запись выдачи в БД со сбросом кэша нового и прежнего владельца файла"""
+    previous = db.get_active_config_by_file(config_file)
+    if previous:
+        issued_cache.pop(previous[1], None)
+    db.add_issued_config(user_id, username, full_name, organization, config_file, issue_type=issue_type)
+    issued_cache.pop(user_id, None)
+
+def get_user_state(user_id):
+    """Получение состояния пользователя с продлением срока жизни"""
+    state = user_states.get(user_id)
+    if state is None:
+        state = UserState()
+    user_states.set(user_id, state)
+    return state
+
+def get_rss_mb():
+    """Объём резидентной памяти процесса в МБ"""
+    try:
+        with open('/proc/self/statm', 'r') as f:
+            rss_pages = int(f.read().split()[1])
+        return rss_pages * os.sysconf('SC_PAGE_SIZE') / (1024 * 1024)
+    except (OSError, ValueError, IndexError):
+        return None
+
+async def purge_state(context: ContextTypes.DEFAULT_TYPE):
+    """Периодическая очистка просроченных состояний"""
+    expired_requests = pending_requests.purge()
+    removed = len(expired_requests) + len(user_states.purge()) + len(issued_cache.purge())
+    user_limiter.purge()
+    org_limiter.purge()
+    if removed:
+        logger.info(f"Очищено просроченных записей состояния: {removed}")
+    
+    # Запросы без решения не должны пропадать молча
+    for user_id, request_data in expired_requests:
+        await notify_request_expired(context, user_id, request_data)
+
+async def notify_request_expired(context: ContextTypes.DEFAULT_TYPE, user_id, request_data):
+    """Уведомление пользователя и администратора об истёкшем запросе"""
+    logger.warning(f"Истёк запрос пользователя {user_id} на конфиг {request_data.config_file}")
+    try:
+        await context.bot.send_message(
+            chat_id=user_id,
+            text="⌛️ Ваш запрос на получение конфига не был рассмотрен вовремя и отменён. "
+                 "Отправьте новый запрос командой /get"
+        )
+    except Exception as e:
+        logger.error(f"Не удалось уведомить пользователя {user_id} об истечении запроса: {e}")
+    await notify_admin(
+        context,
+        f"⌛️ Запрос пользователя ID: {user_id} истёк без решения\n"
+        f"👨‍💼 ФИО: {request_data.full_name}\n"
+        f"🏢 Организация: {request_data.organization}"
+    )
+
+async def expire_pending_request(context: ContextTypes.DEFAULT_TYPE, user_id):
+    """Обработка истёкшего, но ещё не очищенного запроса перед созданием нового"""
+    request_data = pending_requests.pop_expired(user_id)
+    if request_data:
+        await notify_request_expired(context, user_id, request_data)
+
+def reset_conversation_state(user_id):
+    """Сброс данных диалога запроса без затрагивания состояния списка"""
+    state = user_states.get(user_id)
+    if state:
+        state.full_name = None
+
+async def send_existing_config(context: ContextTypes.DEFAULT_TYPE, user_id, config_file):
+    """Повторная отправка уже выданного конфига"""
+    try:
+        with open(os.path.join(USED_DIR, config_file), 'rb') as file:
+            await context.bot.send_document(
+                chat_id=user_id,
+                document=file,
+                caption=f"🔁 У вас уже есть конфиг: {config_file}"
+            )
+        logger.info(f"Пользователю {user_id} повторно отправлен конфиг {config_file}")
+    except Exception as e:
+        logger.error(f"Ошибка повторной отправки конфига {config_file} пользователю {user_id}: {e}")
+        await context.bot.send_message(
+            chat_id=user_id,
+            text="⚠️ У вас уже есть конфиг, но его не удалось отправить. Обратитесь к администратору."
+        )
+
+def format_retry_after(seconds):
+    """Форматирование времени ожидания"""
+    minutes = max(1, (seconds + 59) // 60)
+    return f"{minutes} мин."
+
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Обработка команды /start"""
     user = update.message.from_user
@@ -122,9 +314,23 @@ async def request_config(update: Update, context: ContextTypes.DEFAULT_TYPE):
         query = update.callback_query
         await query.answer()
         user = query.from_user
-        await context.bot.send_message(chat_id=user.id, text="Введите ваше ФИО:")
     else:
         user = update.message.from_user
+    
+    # Повторный запрос не должен перезаписывать ожидающий
+    await expire_pending_request(context, user.id)
+    if user.id in pending_requests:
+        await context.bot.send_message(chat_id=user.id, text="⏳ Ваш запрос уже отправлен администратору. Ожидайте решения.")
+        return ConversationHandler.END
+    
+    config_file = get_cached_config(user.id)
+    if config_file:
+        await send_existing_config(context, user.id, config_file)
+        return ConversationHandler.END
+    
+    if update.callback_query:
+        await context.bot.send_message(chat_id=user.id, text="Введите ваше ФИО:")
+    else:
         await update.message.reply_text("Введите ваше ФИО:")
     
     return FIO
@@ -136,7 +342,7 @@ async def get_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
 async def get_fio(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Получение ФИО от пользователя"""
     user = update.message.from_user
-    context.user_data['full_name'] = update.message.text
+    get_user_state(user.id).full_name = update.message.text
     await update.message.reply_text("Введите вашу организацию:")
     return ORG
 
@@ -144,20 +350,44 @@ async def get_org(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Получение организации от пользователя и отправка запроса администратору"""
     user = update.message.from_user
     organization = update.message.text
-    full_name = context.user_data['full_name']
+    state = user_states.get(user.id)
+    full_name = state.full_name if state else None
+    reset_conversation_state(user.id)
     
-    configs = check_configs()
-    if not configs:
+    if not full_name:
+        await update.message.reply_text("⌛️ Время ожидания истекло. Начните заново командой /get")
+        return ConversationHandler.END
+    
+    await expire_pending_request(context, user.id)
+    if user.id in pending_requests:
+        await update.message.reply_text("⏳ Ваш запрос уже отправлен администратору. Ожидайте решения.")
+        return ConversationHandler.END
+    
+    org_key = organization.strip().lower()
+    if not user_limiter.is_allowed(user.id):
+        logger.warning(f"Превышен лимит запросов пользователем {user.id}")
+        await update.message.reply_text(
+            f"⏳ Слишком много запросов. Повторите через {format_retry_after(user_limiter.retry_after(user.id))}"
+        )
+        return ConversationHandler.END
+    if not org_limiter.is_allowed(org_key):
+        logger.warning(f"Превышен лимит запросов для организации {organization}")
+        await update.message.reply_text(
+            f"⏳ Превышен лимит запросов от вашей организации. "
+            f"Повторите через {format_retry_after(org_limiter.retry_after(org_key))}"
+        )
+        return ConversationHandler.END
+    
+    config_file = await take_config(context)
+    if not config_file:
         await update.message.reply_text("⚠️ Все ключи временно закончились. Администратор уведомлен.")
         await notify_admin(context, "⚠️ ВНИМАНИЕ! Закончились доступные конфиги!")
         return ConversationHandler.END
     
-    config_file = configs[0]
-    pending_requests[user.id] = {
-        'config_file': config_file,
-        'full_name': full_name,
-        'organization': organization
-    }
+    user_limiter.hit(user.id)
+    org_limiter.hit(org_key)
+    request_data = PendingRequest(config_file, full_name, organization)
+    pending_requests.set(user.id, request_data)
     
     username = f"@{user.username}" if user.username else "нет username"
     request_time = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
@@ -173,8 +403,8 @@ async def get_org(update: Update, context: ContextTypes.DEFAULT_TYPE):
     )
     
     keyboard = [
-        [InlineKeyboardButton("✅ Принять", callback_data=f"approve_{user.id}"),
-         InlineKeyboardButton("❌ Отказать", callback_data=f"reject_{user.id}")]
+        [InlineKeyboardButton("✅ Принять", callback_data=f"approve_{user.id}_{request_data.token}"),
+         InlineKeyboardButton("❌ Отказать", callback_data=f"reject_{user.id}_{request_data.token}")]
     ]
     reply_markup = InlineKeyboardMarkup(keyboard)
     
@@ -193,9 +423,21 @@ async def get_org(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
 async def cancel(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Отмена процесса запроса"""
+    reset_conversation_state(update.message.from_user.id)
     await update.message.reply_text("Запрос отменен.")
     return ConversationHandler.END
 
+async def conversation_timeout(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Завершение диалога по таймауту"""
+    user = update.effective_user
+    if not user:
+        return
+    reset_conversation_state(user.id)
+    try:
+        await context.bot.send_message(chat_id=user.id, text="⌛️ Время ожидания истекло. Запрос отменен.")
+    except Exception as e:
+        logger.error(f"Не удалось уведомить пользователя {user.id} о таймауте: {e}")
+
 async def handle_admin_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Обработка действий администратора"""
     query = update.callback_query
@@ -207,15 +449,27 @@ async def handle_admin_callback(update: Update, context: ContextTypes.DEFAULT_TY
         user_id = int(data_parts[1])
         
         request_data = pending_requests.get(user_id)
-        if not request_data:
+        # Кнопки старого сообщения не должны срабатывать для нового запроса того же пользователя
+        token = data_parts[2] if len(data_parts) > 2 else None
+        if not request_data or request_data.token != token:
             await query.edit_message_text("⚠️ Запрос не найден или уже обработан")
             return
         
-        config_file = request_data['config_file']
-        full_name = request_data['full_name']
-        organization = request_data['organization']
+        config_file = request_data.config_file
+        full_name = request_data.full_name
+        organization = request_data.organization
         
         if action == "approve":
+            # Пока запрос ждал решения, лимит конфигов мог быть исчерпан
+            existing_config = get_cached_config(user_id)
+            if existing_config:
+                pending_requests.pop(user_id)
+                await send_existing_config(context, user_id, existing_config)
+                await query.edit_message_text(
+                    f"⚠️ У пользователя ID: {user_id} уже есть конфиг {existing_config}, новый не выдан"
+                )
+                return
+            
             src_path = os.path.join(AVAILABLE_DIR, config_file)
             dest_path = os.path.join(USED_DIR, config_file)
             
@@ -234,7 +488,7 @@ async def handle_admin_callback(update: Update, context: ContextTypes.DEFAULT_TY
                 # Запись в базу данных
                 user_data = await context.bot.get_chat(user_id)
                 username = user_data.username if user_data.username else None
-                db.add_issued_config(user_id, username, full_name, organization, config_file)
+                record_issue(user_id, username, full_name, organization, config_file)
                 
                 # Уведомление администратора
                 await query.edit_message_text(
@@ -246,8 +500,7 @@ async def handle_admin_callback(update: Update, context: ContextTypes.DEFAULT_TY
                 logger.error(f"Ошибка выдачи конфига {user_id}: {e}")
                 await query.edit_message_text(f"🚫 Ошибка выдачи конфига: {e}")
             finally:
-                if user_id in pending_requests:
-                    del pending_requests[user_id]
+                pending_requests.pop(user_id)
         
         elif action == "reject":
             try:
@@ -259,8 +512,7 @@ async def handle_admin_callback(update: Update, context: ContextTypes.DEFAULT_TY
                 logger.error(f"Не удалось уведомить пользователя {user_id}: {e}")
             
             await query.edit_message_text(f"❌ Запрос пользователя ID: {user_id} отклонён")
-            if user_id in pending_requests:
-                del pending_requests[user_id]
+            pending_requests.pop(user_id)
     
     except Exception as e:
         logger.error(f"Ошибка в обработке callback: {e}")
@@ -278,8 +530,9 @@ async def list_issued(update: Update, context: ContextTypes.DEFAULT_TYPE):
             return
         
         # Сброс состояния
-        context.user_data['list_page'] = 0
-        context.user_data['awaiting_delete_id'] = False
+        state = get_user_state(user_id)
+        state.list_page = 0
+        state.awaiting_delete_id = False
         await show_list_page(update, context, is_initial=True)
         
     except Exception as e:
@@ -289,7 +542,7 @@ async def list_issued(update: Update, context: ContextTypes.DEFAULT_TYPE):
 async def show_list_page(update: Update, context: ContextTypes.DEFAULT_TYPE, is_initial=False):
     """Отображение страницы списка"""
     try:
-        page = context.user_data.get('list_page', 0)
+        page = get_user_state(update.effective_user.id).list_page
         limit = 5
         offset = page * limit
         
@@ -313,7 +566,8 @@ async def show_list_page(update: Update, context: ContextTypes.DEFAULT_TYPE, is_
                 logger.error(f"Некорректная запись в БД: {config}")
                 continue
                 
-            record_id, user_id, username, full_name, organization, config_file, issue_time, issue_type = config
+            record_id, user_id, username, full_name, organization, config_file, issue_time, issue_type = config[:8]
+            status = config[8] if len(config) > 8 else 'active'
             message += (
                 f"🔹 ID: {record_id}\n"
                 f"👤 Пользователь: @{username or 'N/A'} (ID: {user_id})\n"
@@ -321,8 +575,13 @@ async def show_list_page(update: Update, context: ContextTypes.DEFAULT_TYPE, is_
                 f"🏢 Организация: {organization}\n"
                 f"🔑 Конфиг: {config_file}\n"
                 f"🕒 Время выдачи: {issue_time}\n"
-                f"⚡️ Тип: {'Быстрая выдача' if issue_type == 'fast' else 'Стандартная'}\n\n"
+                f"⚡️ Тип: {'Быстрая выдача' if issue_type == 'fast' else 'Стандартная'}\n"
             )
+            if status == 'revoked':
+                message += f"⛔️ Отозван: {config[9]}\n"
+            elif status == 'superseded':
+                message += "🔁 Заменён более поздней выдачей\n"
+            message += "\n"
         
         # Создаем клавиатуру для навигации
         keyboard = []
@@ -377,13 +636,14 @@ async def handle_list_callback(update: Update, context: ContextTypes.DEFAULT_TYP
         await query.answer()
         
         action = query.data
+        state = get_user_state(query.from_user.id)
         
         if action == "list_prev":
-            context.user_data['list_page'] = max(0, context.user_data.get('list_page', 0) - 1)
+            state.list_page = max(0, state.list_page - 1)
         elif action == "list_next":
-            context.user_data['list_page'] = context.user_data.get('list_page', 0) + 1
+            state.list_page += 1
         elif action == "delete_record":
-            context.user_data['awaiting_delete_id'] = True
+            state.awaiting_delete_id = True
             await query.message.reply_text("Введите ID записи для удаления:")
             return
         
@@ -395,14 +655,15 @@ async def handle_list_callback(update: Update, context: ContextTypes.DEFAULT_TYP
 
 async def handle_delete_record(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Обработка удаления записи"""
-    # Проверяем, ожидаем ли мы ID для удаления
-    if not context.user_data.get('awaiting_delete_id', False):
+    # Проверяем, ожидаем ли мы ID для удаления (состояние не создаём для произвольных сообщений)
+    state = user_states.get(update.message.from_user.id)
+    if not state or not state.awaiting_delete_id:
         return
     
     # Проверяем, что команда от администратора
     if not is_admin(update.message.from_user.id):
         await update.message.reply_text("⚠️ Удаление записей доступно только администратору")
-        context.user_data['awaiting_delete_id'] = False
+        state.awaiting_delete_id = False
         return
     
     try:
@@ -411,12 +672,13 @@ async def handle_delete_record(update: Update, context: ContextTypes.DEFAULT_TYP
         
         if not config_data:
             await update.message.reply_text("⚠️ Запись с таким ID не найдена")
-            context.user_data['awaiting_delete_id'] = False
+            state.awaiting_delete_id = False
             return
         
         db.delete_issued_config(record_id)
+        issued_cache.pop(config_data[1], None)
         await update.message.reply_text(f"✅ Запись #{record_id} успешно удалена")
-        context.user_data['awaiting_delete_id'] = False
+        state.awaiting_delete_id = False
         
         # Обновляем список
         await show_list_page(update, context, is_initial=True)
@@ -439,13 +701,30 @@ async def get_fast(update: Update, context: ContextTypes.DEFAULT_TYPE):
         await update.message.reply_text("⚠️ Для получения конфига необходимо начать приватный чат с ботом.")
         return
     
-    configs = check_configs()
-    if not configs:
+    await expire_pending_request(context, user.id)
+    if user.id in pending_requests:
+        await update.message.reply_text("⏳ Ваш запрос уже отправлен администратору. Ожидайте решения.")
+        return
+    
+    existing_config = get_cached_config(user.id)
+    if existing_config:
+        await send_existing_config(context, user.id, existing_config)
+        return
+    
+    if not user_limiter.is_allowed(user.id):
+        logger.warning(f"Превышен лимит быстрой выдачи пользователем {user.id}")
+        await update.message.reply_text(
+            f"⏳ Слишком много запросов. Повторите через {format_retry_after(user_limiter.retry_after(user.id))}"
+        )
+        return
+    
+    config_file = await take_config(context)
+    if not config_file:
         # Изменение: не уведомляем администратора при отсутствии конфигов
         await update.message.reply_text("⚠️ Все ключи временно закончились!")
         return
     
-    config_file = configs[0]
+    in_flight_configs.add(config_file)
     src_path = os.path.join(AVAILABLE_DIR, config_file)
     dest_path = os.path.join(USED_DIR, config_file)
     
@@ -463,7 +742,7 @@ async def get_fast(update: Update, context: ContextTypes.DEFAULT_TYPE):
         
         # Запись в базу данных
         username = f"@{user.username}" if user.username else None
-        db.add_issued_config(
+        record_issue(
             user.id, 
             username, 
             "Быстрая выдача", 
@@ -471,6 +750,7 @@ async def get_fast(update: Update, context: ContextTypes.DEFAULT_TYPE):
             config_file,
             issue_type="fast"
         )
+        user_limiter.hit(user.id)
         
         # Уведомление администратора
         username_display = username if username else f"ID: {user.id}"
@@ -494,6 +774,140 @@ async def get_fast(update: Update, context: ContextTypes.DEFAULT_TYPE):
         await update.message.reply_text(
             "⚠️ Не удалось выдать конфиг. Попробуйте позже или обратитесь к администратору."
         )
+    finally:
+        in_flight_configs.discard(config_file)
+
+async def revoke(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Команда для отзыва конфига: /revoke <ID записи или имя файла>"""
+    user_id = update.message.from_user.id
+    
+    if not is_admin(user_id):
+        await update.message.reply_text("⚠️ Эта команда доступна только администратору")
+        return
+    
+    if not context.args:
+        await update.message.reply_text("Использование: /revoke <ID записи или имя файла конфига>")
+        return
+    
+    target = ' '.join(context.args)
+    if target.isdigit():
+        record = db.get_issued_config_by_id(int(target))
+    else:
+        record = db.get_active_config_by_file(target)
+    
+    if not record:
+        await update.message.reply_text("⚠️ Активная запись не найдена")
+        return
+    
+    record_id, config_file, status = record[0], record[5], record[8]
+    if status == 'revoked':
+        await update.message.reply_text(f"⚠️ Конфиг {config_file} уже отозван")
+        return
+    if status != 'active':
+        await update.message.reply_text(f"⚠️ Запись #{record_id} не активна: файл {config_file} выдан повторно позже")
+        return
+    
+    try:
+        src_path = os.path.join(USED_DIR, config_file)
+        dest_path = os.path.join(REVOKED_DIR, config_file)
+        
+        # Перемещение в карантин, чтобы файл не был выдан повторно
+        if os.path.exists(src_path):
+            shutil.move(src_path, dest_path)
+        else:
+            logger.warning(f"Файл {config_file} не найден в {USED_DIR}")
+        
+        if not db.revoke_issued_config(record_id):
+            await update.message.reply_text("⚠️ Не удалось отозвать запись. Подробности в логах.")
+            return
+        
+        issued_cache.pop(record[1], None)
+        logger.info(f"Администратор {user_id} отозвал конфиг {config_file} (запись #{record_id})")
+        
+        message = f"⛔️ Конфиг {config_file} (запись #{record_id}) отозван и перемещён в карантин"
+        reply_markup = None
+        if os.path.exists(dest_path):
+            # Пир бывшего владельца остаётся на сервере, пока его не удалят
+            try:
+                old_public_key = await asyncio.to_thread(wg.config_public_key, dest_path)
+            except Exception as e:
+                logger.error(f"Не удалось определить публичный ключ {config_file}: {e}")
+                old_public_key = None
+            
+            if not old_public_key:
+                message += "\n⚠️ Не удалось определить публичный ключ пира, удалите его на сервере вручную"
+            elif WG_INTERFACE:
+                try:
+                    await asyncio.to_thread(wg.remove_peer, WG_INTERFACE, old_public_key)
+                    message += f"\n🗑 Пир {old_public_key} удалён с сервера"
+                except Exception as e:
+                    logger.error(f"Ошибка удаления пира {old_public_key}: {e}")
+                    message += f"\n⚠️ Не удалось удалить пир автоматически, удалите вручную:\nPublicKey = {old_public_key}"
+            else:
+                message += f"\nУдалите пир на сервере:\nPublicKey = {old_public_key}"
+            keyboard = [[InlineKeyboardButton("♻️ Перевыпустить и вернуть в пул", callback_data=f"recycle_{record_id}")]]
+            reply_markup = InlineKeyboardMarkup(keyboard)
+        
+        await update.message.reply_text(message, reply_markup=reply_markup)
+    except Exception as e:
+        logger.error(f"Ошибка отзыва конфига {config_file}: {e}", exc_info=True)
+        await update.message.reply_text("⚠️ Произошла ошибка при отзыве конфига")
+
+async def handle_recycle_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Перевыпуск ключа отозванного конфига и возврат в пул"""
+    query = update.callback_query
+    await query.answer()
+    
+    if not is_admin(query.from_user.id):
+        return
+    
+    try:
+        record_id = int(query.data.split('_')[1])
+        record = db.get_issued_config_by_id(record_id)
+        if not record:
+            await query.edit_message_text("⚠️ Запись не найдена")
+            return
+        
+        config_file = record[5]
+        src_path = os.path.join(REVOKED_DIR, config_file)
+        dest_path = os.path.join(AVAILABLE_DIR, config_file)
+        
+        if not os.path.exists(src_path):
+            await query.edit_message_text(f"⚠️ Конфиг {config_file} не найден в карантине")
+            return
+        
+        # Старые ключи остаются у бывшего владельца, поэтому выдаём файл только с новыми
+        old_public_key = await asyncio.to_thread(wg.config_public_key, src_path)
+        public_key, preshared_key = await asyncio.to_thread(wg.rekey_config, src_path)
+        address = wg.read_config_value(src_path, 'Address') or ''
+        
+        if WG_INTERFACE:
+            # В пул файл возвращается только после замены пира на сервере
+            try:
+                await asyncio.to_thread(wg.remove_peer, WG_INTERFACE, old_public_key)
+            except Exception as e:
+                # Пир мог быть удалён ещё при отзыве
+                logger.warning(f"Не удалось удалить пир {old_public_key}: {e}")
+            await asyncio.to_thread(wg.add_peer, WG_INTERFACE, public_key, preshared_key, address)
+            shutil.move(src_path, dest_path)
+            await query.edit_message_text(
+                f"♻️ Конфиг {config_file} перевыпущен, пир на сервере заменён, конфиг возвращён в пул"
+            )
+            return
+        
+        shutil.move(src_path, dest_path)
+        await query.edit_message_text(
+            f"♻️ Конфиг {config_file} перевыпущен и возвращён в пул\n"
+            f"Замените пир на сервере.\n"
+            f"Удалить: PublicKey = {old_public_key}\n"
+            f"Добавить:\n"
+            f"PublicKey = {public_key}\n"
+            f"PresharedKey = {preshared_key}\n"
+            f"AllowedIPs = {address.split('/')[0]}/32"
+        )
+    except Exception as e:
+        logger.error(f"Ошибка перевыпуска конфига: {e}", exc_info=True)
+        await query.edit_message_text(f"🚫 Ошибка перевыпуска конфига: {e}")
 
 async def grant_admin(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Команда для выдачи прав администратора"""
@@ -525,6 +939,36 @@ async def handle_grant_admin(update: Update, context: ContextTypes.DEFAULT_TYPE)
     
     return ConversationHandler.END
 
+async def stats(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Команда для вывода статистики и отчёта о памяти"""
+    if not is_admin(update.message.from_user.id):
+        await update.message.reply_text("⚠️ Эта команда доступна только администратору")
+        return
+    
+    status_counts = db.count_issued_configs_by_status()
+    rss_mb = get_rss_mb()
+    message = (
+        f"📊 Статистика\n"
+        f"🔑 Доступно конфигов: {len(check_configs())}\n"
+        f"✅ Активных выдач: {status_counts.get('active', 0)}\n"
+        f"⛔️ Отозвано: {status_counts.get('revoked', 0)}\n"
+    )
+    if config_generator:
+        message += (
+            f"⚙️ Свободных адресов: {config_generator.allocator.free_count()}\n"
+            f"🗝 Ключей в буфере: {len(config_generator.key_pool)}\n"
+        )
+    message += (
+        f"\n🧠 Память\n"
+        f"RSS: {f'{rss_mb:.1f} МБ' if rss_mb is not None else 'н/д'}\n"
+        f"Ожидающие запросы: {len(pending_requests)}\n"
+        f"Состояния пользователей: {len(user_states)}\n"
+        f"Кэш выданных конфигов: {len(issued_cache)}\n"
+        f"Лимитер пользователей: {len(user_limiter)}\n"
+        f"Лимитер организаций: {len(org_limiter)}"
+    )
+    await update.message.reply_text(message)
+
 async def notify_admin(context: ContextTypes.DEFAULT_TYPE, message: str):
     """Уведомление администратора"""
     try:
@@ -539,6 +983,8 @@ def main():
     """Запуск бота"""
     # Инициализация файла администраторов
     init_admins()
+    check_configs()
+    init_generator()
     
     application = Application.builder().token(TOKEN).build()
     
@@ -550,18 +996,22 @@ def main():
         ],
         states={
             FIO: [MessageHandler(filters.TEXT & ~filters.COMMAND, get_fio)],
-            ORG: [MessageHandler(filters.TEXT & ~filters.COMMAND, get_org)]
+            ORG: [MessageHandler(filters.TEXT & ~filters.COMMAND, get_org)],
+            ConversationHandler.TIMEOUT: [TypeHandler(Update, conversation_timeout)]
         },
-        fallbacks=[CommandHandler('cancel', cancel)]
+        fallbacks=[CommandHandler('cancel', cancel)],
+        conversation_timeout=CONVERSATION_TIMEOUT
     )
     
     # Обработчик для выдачи прав администратора
     admin_grant_handler = ConversationHandler(
         entry_points=[CommandHandler('grant_admin', grant_admin)],
         states={
-            GRANT_ADMIN: [MessageHandler(filters.TEXT & ~filters.COMMAND, handle_grant_admin)]
+            GRANT_ADMIN: [MessageHandler(filters.TEXT & ~filters.COMMAND, handle_grant_admin)],
+            ConversationHandler.TIMEOUT: [TypeHandler(Update, conversation_timeout)]
         },
-        fallbacks=[]
+        fallbacks=[],
+        conversation_timeout=CONVERSATION_TIMEOUT
     )
     
     application.add_handler(conv_handler)
@@ -569,13 +1019,19 @@ def main():
     application.add_handler(CommandHandler("start", start))
     application.add_handler(CommandHandler("list", list_issued))
     application.add_handler(CommandHandler("getfast", get_fast))
+    application.add_handler(CommandHandler("revoke", revoke))
+    application.add_handler(CommandHandler("stats", stats))
     application.add_handler(CallbackQueryHandler(handle_admin_callback, pattern='^approve_|^reject_'))
     application.add_handler(CallbackQueryHandler(handle_list_callback, pattern='^list_|^delete_record'))
+    application.add_handler(CallbackQueryHandler(handle_recycle_callback, pattern='^recycle_'))
     application.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, handle_delete_record))
     
+    # Периодическая очистка состояния в памяти
+    application.job_queue.run_repeating(purge_state, interval=STATE_PURGE_INTERVAL)
+    
     # Проверка начальных условий
     configs = check_configs()
-    if not configs:
+    if not configs and not config_generator:
         logger.warning("Нет доступных конфигов!")
         # Используем create_task для асинхронного уведомления
         application.create_task(notify_admin(application, "⚠️ ВНИМАНИЕ! На старте нет доступных конфигов!"))
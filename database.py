@@ -32,13 +32,15 @@ def init_db():
                          organization TEXT NOT NULL,
                          config_file TEXT NOT NULL,
                          issue_time DATETIME NOT NULL,
-                         issue_type TEXT NOT NULL)''')
+                         issue_type TEXT NOT NULL,
+                         status TEXT NOT NULL DEFAULT 'active',
+                         revoke_time DATETIME)''')
             logger.info("Таблица issued_configs создана")
         else:
             # Проверяем структуру существующей таблицы
             c.execute("PRAGMA table_info(issued_configs)")
             columns = [col[1] for col in c.fetchall()]
-            required_columns = ['id', 'user_id', 'username', 'full_name', 'organization', 'config_file', 'issue_time', 'issue_type']
+            required_columns = ['id', 'user_id', 'username', 'full_name', 'organization', 'config_file', 'issue_time', 'issue_type', 'status', 'revoke_time']
             
             # Добавляем отсутствующие колонки
             for col in required_columns:
@@ -47,6 +49,10 @@ def init_db():
                         c.execute("ALTER TABLE issued_configs ADD COLUMN issue_type TEXT NOT NULL DEFAULT 'standard'")
                     elif col == 'issue_time':
                         c.execute("ALTER TABLE issued_configs ADD COLUMN issue_time DATETIME NOT NULL DEFAULT CURRENT_TIMESTAMP")
+                    elif col == 'status':
+                        c.execute("ALTER TABLE issued_configs ADD COLUMN status TEXT NOT NULL DEFAULT 'active'")
+                    elif col == 'revoke_time':
+                        c.execute("ALTER TABLE issued_configs ADD COLUMN revoke_time DATETIME")
                     else:
                         # Для других колонок определяем тип
                         col_type = 'TEXT'
@@ -56,6 +62,22 @@ def init_db():
                     
                     logger.warning(f"Добавлена колонка {col} в таблицу issued_configs")
         
+        # Повторные выдачи одного файла: активной остаётся только последняя запись
+        c.execute('''UPDATE issued_configs SET status = 'superseded'
+                     WHERE status = 'active' AND id NOT IN (
+                         SELECT MAX(id) FROM issued_configs WHERE status = 'active' GROUP BY config_file)''')
+        if c.rowcount > 0:
+            logger.warning(f"Помечено заменённых записей: {c.rowcount}")
+        
+        # Уникальный индекс: не больше одной активной записи на файл конфига
+        c.execute("DROP INDEX IF EXISTS idx_issued_configs_active_file")
+        c.execute('''CREATE UNIQUE INDEX IF NOT EXISTS idx_issued_configs_active_file_unique
+                     ON issued_configs (config_file) WHERE status = 'active' ''')
+        
+        # Индекс для проверки наличия конфигов у пользователя
+        c.execute('''CREATE INDEX IF NOT EXISTS idx_issued_configs_user
+                     ON issued_configs (user_id, status)''')
+        
         conn.commit()
         logger.info("База данных инициализирована")
     except Exception as e:
@@ -70,6 +92,9 @@ def add_issued_config(user_id, username, full_name, organization, config_file, i
         conn = sqlite3.connect(DB_PATH)
         c = conn.cursor()
         issue_time = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+        # Файл, возвращённый в пул вручную, выдаётся заново — прежняя запись больше не активна
+        c.execute("UPDATE issued_configs SET status = 'superseded' WHERE config_file = ? AND status = 'active'",
+                  (config_file,))
         c.execute('''INSERT INTO issued_configs 
                      (user_id, username, full_name, organization, config_file, issue_time, issue_type) 
                      VALUES (?, ?, ?, ?, ?, ?, ?)''',
@@ -127,6 +152,72 @@ def delete_issued_config(record_id):
         if conn:
             conn.close()
 
+def get_active_config_by_file(config_file):
+    conn = None
+    try:
+        conn = sqlite3.connect(DB_PATH)
+        c = conn.cursor()
+        c.execute("SELECT * FROM issued_configs WHERE config_file = ? AND status = 'active'", (config_file,))
+        result = c.fetchone()
+        return result
+    except Exception as e:
+        logger.error(f"Ошибка получения активной записи по файлу: {e}", exc_info=True)
+        return None
+    finally:
+        if conn:
+            conn.close()
+
+def get_active_configs_by_user(user_id):
+    conn = None
+    try:
+        conn = sqlite3.connect(DB_PATH)
+        c = conn.cursor()
+        c.execute("SELECT * FROM issued_configs WHERE user_id = ? AND status = 'active' ORDER BY issue_time DESC",
+                  (user_id,))
+        results = c.fetchall()
+        return results
+    except Exception as e:
+        logger.error(f"Ошибка получения конфигов пользователя: {e}", exc_info=True)
+        return []
+    finally:
+        if conn:
+            conn.close()
+
+def revoke_issued_config(record_id):
+    conn = None
+    try:
+        conn = sqlite3.connect(DB_PATH)
+        c = conn.cursor()
+        revoke_time = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+        c.execute("UPDATE issued_configs SET status = 'revoked', revoke_time = ? WHERE id = ? AND status = 'active'",
+                  (revoke_time, record_id))
+        conn.commit()
+        revoked = c.rowcount > 0
+        if revoked:
+            logger.info(f"Запись #{record_id} отозвана")
+        return revoked
+    except Exception as e:
+        logger.error(f"Ошибка отзыва записи в БД: {e}", exc_info=True)
+        return False
+    finally:
+        if conn:
+            conn.close()
+
+def count_issued_configs_by_status():
+    conn = None
+    try:
+        conn = sqlite3.connect(DB_PATH)
+        c = conn.cursor()
+        c.execute("SELECT status, COUNT(*) FROM issued_configs GROUP BY status")
+        counts = dict(c.fetchall())
+        return counts
+    except Exception as e:
+        logger.error(f"Ошибка подсчета записей по статусу: {e}", exc_info=True)
+        return {}
+    finally:
+        if conn:
+            conn.close()
+
 def count_issued_configs():
     conn = None
     try:
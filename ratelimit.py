@@ -0,0 +1,56 @@
+import time
+from collections import deque
+
+class SlidingWindowLimiter:
+    """Ограничение числа запросов по ключу в скользящем окне"""
+
+    def __init__(self, limit, window):
+        self.limit = limit  # Количество запросов в окне (0 — без ограничений)
+        self.window = window  # Длина окна в секундах
+        self._hits = {}
+
+    def _prune(self, key, now):
+        """Удаление отметок, вышедших за пределы окна"""
+        hits = self._hits.get(key)
+        if hits is None:
+            return None
+        while hits and hits[0] <= now - self.window:
+            hits.popleft()
+        if not hits:
+            del self._hits[key]
+            return None
+        return hits
+
+    def is_allowed(self, key):
+        """Проверка без учёта запроса"""
+        if self.limit <= 0:
+            return True
+        hits = self._prune(key, time.monotonic())
+        return hits is None or len(hits) < self.limit
+
+    def hit(self, key):
+        """Учёт запроса"""
+        if self.limit <= 0:
+            return
+        now = time.monotonic()
+        hits = self._prune(key, now)
+        if hits is None:
+            hits = self._hits[key] = deque()
+        hits.append(now)
+
+    def retry_after(self, key):
+        """Количество секунд до освобождения слота"""
+        now = time.monotonic()
+        hits = self._prune(key, now)
+        if hits is None or len(hits) < self.limit:
+            return 0
+        return max(0, int(hits[0] + self.window - now) + 1)
+
+    def purge(self):
+        """Удаление ключей без запросов в текущем окне"""
+        now = time.monotonic()
+        for key in list(self._hits):
+            self._prune(key, now)
+
+    def __len__(self):
+        return len(self._hits)
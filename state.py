@@ -0,0 +1,83 @@
+import time
+import secrets
+from collections import OrderedDict
+
+class TTLStore:
+    """Хранилище с вытеснением записей по времени жизни и по размеру"""
+
+    def __init__(self, ttl, max_size=None):
+        self.ttl = ttl  # Время жизни записи в секундах
+        self.max_size = max_size  # Максимальное число записей (None — без ограничения)
+        self._data = OrderedDict()  # key -> (expires_at, value), упорядочено по сроку жизни
+
+    def get(self, key, default=None):
+        item = self._data.get(key)
+        # Просроченные записи удаляет только purge(), чтобы их можно было обработать
+        if item is None or item[0] <= time.monotonic():
+            return default
+        return item[1]
+
+    def set(self, key, value):
+        """Запись значения с обновлением срока жизни"""
+        self._data[key] = (time.monotonic() + self.ttl, value)
+        self._data.move_to_end(key)
+        if self.max_size is not None:
+            while len(self._data) > self.max_size:
+                self._data.popitem(last=False)
+
+    def pop(self, key, default=None):
+        value = self.get(key, default)
+        self._data.pop(key, None)
+        return value
+
+    def pop_expired(self, key, default=None):
+        """Удаление записи, только если она просрочена; возвращает её значение"""
+        item = self._data.get(key)
+        if item is None or item[0] > time.monotonic():
+            return default
+        del self._data[key]
+        return item[1]
+
+    def purge(self):
+        """Удаление просроченных записей, возвращает список удалённых пар (ключ, значение)"""
+        now = time.monotonic()
+        removed = []
+        # Срок жизни у всех записей одинаковый, поэтому просроченные всегда в начале
+        while self._data:
+            key, (expires_at, value) = next(iter(self._data.items()))
+            if expires_at > now:
+                break
+            del self._data[key]
+            removed.append((key, value))
+        return removed
+
+    def values(self):
+        """Значения всех записей, включая ещё не очищенные просроченные"""
+        return [value for _, value in self._data.values()]
+
+    def __contains__(self, key):
+        return self.get(key, _MISSING) is not _MISSING
+
+    def __len__(self):
+        return len(self._data)
+
+_MISSING = object()
+
+class UserState:
+    """Состояние диалога пользователя"""
+    __slots__ = ('full_name', 'list_page', 'awaiting_delete_id')
+
+    def __init__(self):
+        self.full_name = None
+        self.list_page = 0
+        self.awaiting_delete_id = False
+
+class PendingRequest:
+    """Запрос конфига, ожидающий решения администратора"""
+    __slots__ = ('config_file', 'full_name', 'organization', 'token')
+
+    def __init__(self, config_file, full_name, organization):
+        self.config_file = config_file
+        self.full_name = full_name
+        self.organization = organization
+        self.token = secrets.token_hex(4)  # Привязывает кнопки администратора к этому запросу
@@ -0,0 +1,323 @@
+import os
+import re
+import queue
+import ipaddress
+import threading
+import subprocess
+import logging
+from concurrent.futures import ThreadPoolExecutor
+
+logger = logging.getLogger(__name__)
+
+# Шаблон клиентского конфига для режима генерации
+CONFIG_TEMPLATE = """[Interface]
+PrivateKey = {private_key}
+Address = {address}
+DNS = {dns}
+
+[Peer]
+PublicKey = {server_public_key}
+PresharedKey = {preshared_key}
+AllowedIPs = {allowed_ips}
+PersistentKeepalive = {keepalive}
+Endpoint = {endpoint}
+"""
+
+CONFIG_NAME_RE = re.compile(r'^Vpn_conf_(\d+)\.conf$')
+
+def _run_wg(args, stdin=None):
+    """Вызов утилиты wg и возврат её вывода"""
+    result = subprocess.run(
+        ['wg', *args],
+        input=stdin or '',
+        capture_output=True,
+        text=True,
+        check=True,
+        timeout=10
+    )
+    return result.stdout.strip()
+
+def generate_keypair():
+    """Генерация пары ключей WireGuard (приватный, публичный)"""
+    private_key = _run_wg(['genkey'])
+    public_key = _run_wg(['pubkey'], stdin=private_key)
+    return private_key, public_key
+
+def generate_preshared_key():
+    """Генерация общего ключа WireGuard"""
+    return _run_wg(['genpsk'])
+
+def config_public_key(path):
+    """Публичный ключ клиента, вычисленный из PrivateKey конфига"""
+    private_key = read_config_value(path, 'PrivateKey')
+    if not private_key:
+        raise ValueError(f"В конфиге {os.path.basename(path)} нет PrivateKey")
+    return _run_wg(['pubkey'], stdin=private_key)
+
+def add_peer(interface, public_key, preshared_key, address):
+    """Добавление пира на сервер через wg set"""
+    _run_wg(['set', interface, 'peer', public_key,
+             'preshared-key', '/dev/stdin', 'allowed-ips', f"{str(address).split('/')[0]}/32"],
+            stdin=preshared_key)
+
+def remove_peer(interface, public_key):
+    """Удаление пира с сервера через wg set"""
+    _run_wg(['set', interface, 'peer', public_key, 'remove'])
+
+def peer_allowed_ips(interface):
+    """Адреса всех пиров интерфейса сервера по данным wg show"""
+    addresses = []
+    for line in _run_wg(['show', interface, 'allowed-ips']).splitlines():
+        # Формат строки: <публичный ключ>\t<адрес> <адрес> ... или (none)
+        addresses.extend(a for a in line.split()[1:] if a != '(none)')
+    return addresses
+
+def read_config_value(path, key):
+    """Чтение значения параметра из файла конфига"""
+    with open(path, 'r') as f:
+        for line in f:
+            name, sep, value = line.partition('=')
+            if sep and name.strip() == key:
+                return value.strip()
+    return None
+
+def rekey_config(path):
+    """Замена приватного и общего ключей в конфиге, возвращает новый публичный и общий ключи"""
+    with open(path, 'r') as f:
+        lines = f.readlines()
+
+    private_key, public_key = generate_keypair()
+    preshared_key = generate_preshared_key()
+    new_values = {'PrivateKey': private_key, 'PresharedKey': preshared_key}
+    replaced = set()
+    for i, line in enumerate(lines):
+        name = line.partition('=')[0].strip()
+        if name in new_values and name not in replaced:
+            lines[i] = f"{name} = {new_values[name]}\n"
+            replaced.add(name)
+
+    missing = set(new_values) - replaced
+    if missing:
+        raise ValueError(f"В конфиге {os.path.basename(path)} нет {', '.join(sorted(missing))}")
+
+    # Запись через временный файл, чтобы не оставить конфиг в полусостоянии
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'w') as f:
+        f.writelines(lines)
+    os.replace(tmp_path, path)
+
+    logger.info(f"Перевыпущены ключи конфига {os.path.basename(path)}")
+    return public_key, preshared_key
+
+class IPAllocator:
+    """Выдача адресов подсети по битовой карте занятых адресов"""
+
+    def __init__(self, subnet, server_address=None):
+        self.network = ipaddress.ip_network(subnet)
+        self._size = self.network.num_addresses
+        self._used = 0  # Бит i установлен, если занят адрес network_address + i
+        self._count = 0
+        # Адрес сети, широковещательный адрес и адрес сервера не выдаются
+        self.reserve(self.network.network_address)
+        self.reserve(self.network.broadcast_address)
+        self.reserve(server_address or next(self.network.hosts()))
+
+    def reserve(self, address):
+        """Пометка адреса как занятого"""
+        address = ipaddress.ip_address(str(address).split('/')[0])
+        if address not in self.network:
+            return
+        bit = 1 << (int(address) - int(self.network.network_address))
+        if not self._used & bit:
+            self._used |= bit
+            self._count += 1
+
+    def allocate(self):
+        """Выдача свободного адреса с наименьшим номером"""
+        if self._count >= self._size:
+            return None
+        # Младший нулевой бит карты — первый свободный адрес
+        index = ((self._used + 1) & ~self._used).bit_length() - 1
+        self._used |= 1 << index
+        self._count += 1
+        return self.network.network_address + index
+
+    def release(self, address):
+        """Освобождение ранее выданного адреса"""
+        bit = 1 << (int(ipaddress.ip_address(address)) - int(self.network.network_address))
+        if self._used & bit:
+            self._used &= ~bit
+            self._count -= 1
+
+    def free_count(self):
+        return self._size - self._count
+
+class KeyPool:
+    """Буфер ключей, заранее сгенерированных в фоновых потоках"""
+
+    def __init__(self, size, low_watermark, workers=2):
+        self.size = size
+        self.low_watermark = low_watermark
+        self._keys = queue.Queue()
+        self._in_flight = 0
+        self._lock = threading.Lock()
+        self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='wg-keygen')
+        self.refill()
+
+    def _generate(self):
+        try:
+            private_key, public_key = generate_keypair()
+            self._keys.put((private_key, public_key, generate_preshared_key()))
+        except Exception as e:
+            logger.error(f"Ошибка фоновой генерации ключей: {e}")
+        finally:
+            with self._lock:
+                self._in_flight -= 1
+
+    def refill(self):
+        """Дозаполнение буфера до полного размера"""
+        with self._lock:
+            missing = self.size - self._keys.qsize() - self._in_flight
+            if missing <= 0:
+                return
+            self._in_flight += missing
+        for _ in range(missing):
+            self._executor.submit(self._generate)
+
+    def get(self):
+        """Получение ключей (приватный, публичный, общий)"""
+        try:
+            keys = self._keys.get_nowait()
+        except queue.Empty:
+            # Буфер исчерпан — генерируем синхронно
+            logger.warning("Буфер ключей пуст, генерация по запросу")
+            private_key, public_key = generate_keypair()
+            keys = (private_key, public_key, generate_preshared_key())
+        if self._keys.qsize() < self.low_watermark:
+            self.refill()
+        return keys
+
+    def __len__(self):
+        return self._keys.qsize()
+
+class ConfigGenerator:
+    """Генерация клиентских конфигов по шаблону"""
+
+    def __init__(self, server_public_key, endpoint, subnet, config_dirs, server_address=None,
+                 dns='1.1.1.1', allowed_ips='0.0.0.0/0, ::/0', keepalive=0, interface=None,
+                 key_pool_size=20, key_pool_low_watermark=5, keygen_workers=2):
+        self.server_public_key = server_public_key
+        self.endpoint = endpoint
+        self.dns = dns
+        self.allowed_ips = allowed_ips
+        self.keepalive = keepalive
+        self.interface = interface  # Интерфейс сервера для автоматического добавления пира
+        self.allocator = IPAllocator(subnet, server_address)
+        self.key_pool = KeyPool(key_pool_size, key_pool_low_watermark, keygen_workers)
+        self.config_dirs = config_dirs
+        self._last_number = 0
+        self._lock = threading.Lock()  # generate() вызывается из потоков
+
+        # Адреса всех существующих конфигов считаются занятыми, имя важно только для нумерации
+        for config_dir in config_dirs:
+            if not os.path.exists(config_dir):
+                continue
+            for name in os.listdir(config_dir):
+                if not name.endswith('.conf'):
+                    continue
+                match = CONFIG_NAME_RE.match(name)
+                if match:
+                    self._last_number = max(self._last_number, int(match.group(1)))
+                self._reserve_config_address(os.path.join(config_dir, name))
+
+        # Пиры на сервере могут не иметь файла на диске
+        if self.interface:
+            for address in peer_allowed_ips(self.interface):
+                self._reserve_address(address)
+
+        logger.info(f"Генератор конфигов готов, свободных адресов: {self.allocator.free_count()}")
+
+    def _reserve_address(self, address):
+        try:
+            self.allocator.reserve(address)
+        except ValueError:
+            logger.warning(f"Некорректный адрес пропущен: {address}")
+
+    def _reserve_config_address(self, path):
+        """Пометка адресов из конфига как занятых"""
+        try:
+            addresses = read_config_value(path, 'Address')
+        except OSError as e:
+            logger.warning(f"Не удалось прочитать {path}: {e}")
+            return
+        for address in (addresses or '').split(','):
+            if address.strip():
+                self._reserve_address(address.strip())
+
+    def _next_config_file(self):
+        """Следующее имя файла, которого нет ни в одной из папок конфигов (вызывается под _lock)"""
+        while True:
+            self._last_number += 1
+            config_file = f"Vpn_conf_{self._last_number:03d}.conf"
+            existing = [os.path.join(d, config_file) for d in self.config_dirs
+                        if os.path.exists(os.path.join(d, config_file))]
+            if not existing:
+                return config_file
+            # Файл добавлен после запуска — его адрес тоже занят
+            for path in existing:
+                self._reserve_config_address(path)
+
+    def generate(self, dest_dir):
+        """Создание конфига, возвращает имя файла и настройки пира для ручного добавления"""
+        private_key, public_key, preshared_key = self.key_pool.get()
+
+        with self._lock:
+            # Имя выбирается первым: при этом резервируются адреса файлов, добавленных после запуска
+            config_file = self._next_config_file()
+            address = self.allocator.allocate()
+            if address is None:
+                raise RuntimeError(f"В подсети {self.allocator.network} не осталось свободных адресов")
+
+        tmp_path = os.path.join(dest_dir, config_file + '.tmp')
+        try:
+            with open(tmp_path, 'w') as f:
+                f.write(CONFIG_TEMPLATE.format(
+                    private_key=private_key,
+                    address=f"{address}/{self.allocator.network.prefixlen}",
+                    dns=self.dns,
+                    server_public_key=self.server_public_key,
+                    preshared_key=preshared_key,
+                    allowed_ips=self.allowed_ips,
+                    keepalive=self.keepalive,
+                    endpoint=self.endpoint
+                ))
+            # Файл попадает в пул только после того, как пир добавлен на сервер
+            if self.interface:
+                add_peer(self.interface, public_key, preshared_key, address)
+            # Жёсткая ссылка не перезаписывает файл, появившийся под тем же именем
+            while True:
+                try:
+                    os.link(tmp_path, os.path.join(dest_dir, config_file))
+                    break
+                except FileExistsError:
+                    with self._lock:
+                        config_file = self._next_config_file()
+            os.remove(tmp_path)
+        except Exception:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            with self._lock:
+                self.allocator.release(address)
+            raise
+
+        logger.info(f"Сгенерирован конфиг {config_file} с адресом {address}")
+        if self.interface:
+            return config_file, None
+
+        peer_settings = (
+            f"[Peer]\n"
+            f"PublicKey = {public_key}\n"
+            f"PresharedKey = {preshared_key}\n"
+            f"AllowedIPs = {address}/32"
+        )
+        return config_file, peer_settings